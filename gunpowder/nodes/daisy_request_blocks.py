@@ -1,6 +1,7 @@
 from gunpowder.batch import Batch
 from gunpowder.ext import daisy
 from gunpowder.nodes.batch_filter import BatchFilter
+from gunpowder.producer_pool import ProducerPool
 from gunpowder.roi import Roi
 import logging
 import multiprocessing
@@ -57,9 +58,37 @@ class DaisyRequestBlocks(BatchFilter):
         self.roi_map = roi_map
         self.num_workers = num_workers
         self.block_done_callback = block_done_callback
+        self.workers = None
 
-        if num_workers > 1:
+    def setup(self):
+        # check the roi_map once, instead of for each block
+        for key, _ in self.reference.items():
+            roi_type = self.roi_map.get(key, None)
+
+            if roi_type is None:
+                raise RuntimeError(
+                    "roi_map does not map item %s to either 'read_roi' "
+                    "or 'write_roi'" % key
+                )
+
+            if roi_type not in ("read_roi", "write_roi"):
+                raise RuntimeError(
+                    "%s is not a vaid ROI type (read_roi or write_roi)" % roi_type
+                )
+
+        if self.num_workers > 1:
+            # workers are started once and wait for a signal on the request
+            # queue for each call to provide
             self.request_queue = multiprocessing.Queue(maxsize=0)
+            self.workers = ProducerPool(
+                [self._worker_get_chunks for _ in range(self.num_workers)],
+                queue_size=self.num_workers,
+            )
+            self.workers.start()
+
+    def teardown(self):
+        if self.num_workers > 1:
+            self.workers.stop()
 
     def provide(self, request):
         empty_request = len(request) == 0
@@ -67,59 +96,54 @@ class DaisyRequestBlocks(BatchFilter):
             raise RuntimeError("requests made to DaisyRequestBlocks have to be empty")
 
         if self.num_workers > 1:
-            self.workers = [
-                multiprocessing.Process(target=self.__get_chunks)
-                for _ in range(self.num_workers)
-            ]
-
-            for worker in self.workers:
-                worker.start()
+            for _ in range(self.num_workers):
+                self.request_queue.put(True)
 
-            for worker in self.workers:
-                worker.join()
+            # each worker reports back once daisy has no more blocks for it
+            for _ in range(self.num_workers):
+                num_blocks = self.workers.get()
+                logger.debug("worker finished after %d blocks", num_blocks)
 
         else:
             self.__get_chunks()
 
         return Batch()
 
+    def _worker_get_chunks(self):
+        self.request_queue.get()
+        return self.__get_chunks()
+
     def __get_chunks(self):
         daisy_client = daisy.Client()
+        num_blocks = 0
 
         while True:
             with daisy_client.acquire_block() as block:
                 if block is None:
-                    return
+                    return num_blocks
 
                 logger.info("Processing block %s", block)
                 start = time.time()
 
                 chunk_request = self.reference.copy()
 
-                for key, reference_spec in self.reference.items():
-                    roi_type = self.roi_map.get(key, None)
-
-                    if roi_type is None:
-                        raise RuntimeError(
-                            "roi_map does not map item %s to either 'read_roi' "
-                            "or 'write_roi'" % key
-                        )
-
-                    if roi_type == "read_roi":
-                        chunk_request[key].roi = Roi(
-                            block.read_roi.offset, block.read_roi.shape
-                        )
-                    elif roi_type == "write_roi":
-                        chunk_request[key].roi = Roi(
-                            block.write_roi.offset, block.write_roi.shape
-                        )
-                    else:
-                        raise RuntimeError(
-                            "%s is not a vaid ROI type (read_roi or write_roi)"
-                        )
+                # the block ROIs are the same for all keys, create them only
+                # once per block
+                block_rois = {
+                    "read_roi": Roi(block.read_roi.offset, block.read_roi.shape),
+                    "write_roi": Roi(block.write_roi.offset, block.write_roi.shape),
+                }
 
+                for key, _ in self.reference.items():
+                    chunk_request[key].roi = block_rois[self.roi_map[key]]
+
+                # one upstream request per block, after the request has been
+                # assembled for all keys; the block itself is released (and
+                # marked as failed on exceptions) once by the context manager
                 self.get_upstream_provider().request_batch(chunk_request)
 
                 end = time.time()
                 if self.block_done_callback:
                     self.block_done_callback(block, start, end - start)
+
+                num_blocks += 1
@@ -1,7 +1,15 @@
+import contextlib
+import functools
 import logging
 import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
 import numpy as np
+import os
+import queue
+import time
 import tqdm
+import weakref
 from abc import ABC
 from gunpowder.array import Array
 from gunpowder.batch import Batch
@@ -54,16 +62,78 @@ class TqdmCallback(ScanCallback):
         logger.info("scanning over %d chunks", num_total)
 
         self.progress_bar = tqdm.tqdm(desc="Scan, chunks processed", total=num_total)
+        self.num_total = num_total
         self.num_processed = 0
+        self.last_update = time.monotonic()
 
     def update(self, num_processed):
+        # updating the progress bar for every chunk is expensive for small
+        # chunks, update at most every 0.1s (and for the last chunk)
+        now = time.monotonic()
+        if now - self.last_update < 0.1 and num_processed < self.num_total:
+            return
+
         self.progress_bar.update(num_processed - self.num_processed)
         self.num_processed = num_processed
+        self.last_update = now
 
     def stop(self):
         self.progress_bar.close()
 
 
+class SharedArrayData:
+    """Holds the data of a numpy array in shared memory, such that it can be
+    sent from a :class:`Scan` worker to the main process without pickling
+    it.
+
+    Created in the worker, after which the array is only accessible via
+    :func:`attach` in the receiving process. The shared memory is freed with
+    :func:`release`.
+    """
+
+    # arrays smaller than that are cheaper to pickle
+    min_bytes = 1 << 16
+
+    def __init__(self, data):
+        shared_memory = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=max(1, data.nbytes)
+        )
+        np.copyto(
+            np.ndarray(data.shape, data.dtype, buffer=shared_memory.buf),
+            data,
+            casting="no",
+        )
+
+        self.name = shared_memory.name
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.shared_memory = None
+
+        shared_memory.close()
+
+    def attach(self):
+        """Get a numpy array backed by the shared memory. All references to
+        this array have to be dropped before calling :func:`release`."""
+
+        self.shared_memory = multiprocessing.shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, self.dtype, buffer=self.shared_memory.buf)
+
+    def release(self):
+        if self.shared_memory is None:
+            self.shared_memory = multiprocessing.shared_memory.SharedMemory(
+                name=self.name
+            )
+
+        try:
+            self.shared_memory.close()
+        except BufferError:
+            # arrays still reference the memory (e.g., held by a traceback),
+            # it will be unmapped once they are gone
+            logger.debug("shared memory %s still in use", self.name)
+
+        self.shared_memory.unlink()
+
+
 class Scan(BatchFilter):
     """Iteratively requests batches of size ``reference`` from upstream
     providers in a scanning fashion, until all requested ROIs are covered. If
@@ -97,29 +167,85 @@ class Scan(BatchFilter):
             A callback instance to get updated from this node while processing
             chunks. See :class:`ScanCallback` for details. The default is a
             callback that shows a ``tqdm`` progress bar.
+
+        shared_memory (``bool``, optional):
+
+            If multiple workers are used, send large arrays from the workers to
+            this node via shared memory instead of pickling them. The arrays
+            of the returned batch are allocated in shared memory as well, such
+            that workers can copy their chunks into them directly. Make sure
+            that enough shared memory is available for the returned batch and
+            ``cache_size`` batches (on Linux, the size of ``/dev/shm``).
+
+        pin_workers (``bool``, optional):
+
+            If multiple workers are used, pin each of them to a different CPU
+            (out of the CPUs this process is allowed to run on), such that
+            they keep their caches warm. Only supported on Linux. Upstream
+            nodes that use several threads themselves will be limited to a
+            single CPU per worker.
     """
 
-    def __init__(self, reference, num_workers=1, cache_size=50, progress_callback=None):
+    def __init__(
+        self,
+        reference,
+        num_workers=1,
+        cache_size=50,
+        progress_callback=None,
+        shared_memory=False,
+        pin_workers=False,
+    ):
         self.reference = reference.copy()
+        # offsets of all reference ROIs, to shift them all at once
+        self.reference_offsets = np.array(
+            [spec.roi.offset for _, spec in self.reference.items()]
+        )
         self.num_workers = num_workers
         self.cache_size = cache_size
+        self.shared_memory = shared_memory
+        self.pin_workers = pin_workers
+        self.worker_pinned = False
         self.workers = None
         self.batch = None
+        self.batch_shared_memory = None
+        self.batch_target = None
+        self.stride = None
+        self.shifts_cache = None
         if progress_callback is None:
             self.progress_callback = TqdmCallback()
         else:
             self.progress_callback = progress_callback
 
     def setup(self):
+        # the stride and shifts depend on the upstream spec
+        self.stride = None
+        self.shifts_cache = None
+
         if self.num_workers > 1:
-            self.request_queue = multiprocessing.Queue(maxsize=0)
+            if self.shared_memory:
+                # start the resource tracker before the workers, such that
+                # they share it with this process and shared memory created
+                # in a worker can be released in this process
+                multiprocessing.resource_tracker.ensure_running()
+
+            # one request queue per worker, such that workers don't compete
+            # for the same queue
+            self.request_queues = [
+                multiprocessing.Queue(maxsize=0) for _ in range(self.num_workers)
+            ]
             self.workers = ProducerPool(
-                [self._worker_get_chunk for _ in range(self.num_workers)],
+                [
+                    functools.partial(self._worker_get_chunks, worker_index)
+                    for worker_index in range(self.num_workers)
+                ],
                 queue_size=self.cache_size,
             )
             self.workers.start()
 
     def teardown(self):
+        self.stride = None
+        self.shifts_cache = None
+
         if self.num_workers > 1:
             self.workers.stop()
 
@@ -130,10 +256,11 @@ class Scan(BatchFilter):
         else:
             scan_spec = request
 
-        stride = self._get_stride()
+        if self.stride is None:
+            self.stride = self._get_stride()
         shift_roi = self._get_shift_roi(scan_spec)
 
-        shifts = self._enumerate_shifts(shift_roi, stride)
+        shifts = self._get_shifts(shift_roi, self.stride)
         num_chunks = len(shifts)
 
         if self.progress_callback is not None:
@@ -143,24 +270,62 @@ class Scan(BatchFilter):
         self.batch = Batch()
 
         if self.num_workers > 1:
-            for shift in shifts:
-                shifted_reference = self._shift_request(self.reference, shift)
-                self.request_queue.put(shifted_reference)
-
-            for i in range(num_chunks):
-                chunk = self.workers.get()
-
-                if not empty_request:
-                    self._add_to_batch(request, chunk)
-
-                if self.progress_callback is not None:
-                    self.progress_callback.update(i + 1)
-
-                logger.debug("processed chunk %d/%d", i + 1, num_chunks)
+            # send requests to the workers in groups, to pay the queue
+            # overhead only once per group instead of once per chunk
+            group_size = self._get_group_size(num_chunks)
+            groups = self._group_shifts(shifts, group_size)
+
+            try:
+                # keep at most two groups per worker in flight (fewer if they
+                # would hold more than cache_size batches), the remaining
+                # groups are sent to the workers that return results
+                num_pending = 0
+                for _ in range(self._get_groups_per_worker(group_size)):
+                    for request_queue in self.request_queues:
+                        group = next(groups, None)
+                        if group is not None:
+                            request_queue.put((group, self.batch_target))
+                            num_pending += 1
+
+                i = 0
+                while num_pending > 0:
+                    worker_index, chunks = self.workers.get()
+                    num_pending -= 1
+
+                    try:
+                        for chunk in chunks:
+                            if not empty_request:
+                                with self._attach_shared_arrays(chunk):
+                                    self._add_to_batch(request, chunk)
+
+                            i += 1
+
+                            if self.progress_callback is not None:
+                                self.progress_callback.update(i)
+
+                            logger.debug("processed chunk %d/%d", i, num_chunks)
+                    finally:
+                        for chunk in chunks:
+                            self._release_shared_arrays(chunk)
+
+                    # send the next group after processing the chunks, such
+                    # that it can target the batch if it was just allocated
+                    group = next(groups, None)
+                    if group is not None:
+                        self.request_queues[worker_index].put(
+                            (group, self.batch_target)
+                        )
+                        num_pending += 1
+
+            finally:
+                # the batch arrays stay valid, only the name is removed
+                if self.batch_shared_memory is not None:
+                    self.batch_shared_memory.unlink()
+                self.batch_shared_memory = None
+                self.batch_target = None
 
         else:
-            for i, shift in enumerate(shifts):
-                shifted_reference = self._shift_request(self.reference, shift)
+            for i, shifted_reference in enumerate(self._shift_references(shifts)):
                 chunk = self._get_chunk(shifted_reference)
 
                 if not empty_request:
@@ -232,7 +397,6 @@ class Scan(BatchFilter):
 
             logger.debug("upstream ROI is %s", spec[key].roi)
 
-            print(f"{reference_spec=}")
             for r, s in zip(reference_spec.roi.shape, spec[key].roi.shape):
                 assert s is None or r <= s, (
                     "reference %s with ROI %s does not fit into provided "
@@ -303,54 +467,218 @@ class Scan(BatchFilter):
 
         return total_shift_roi
 
+    def _get_shifts(self, shift_roi, stride):
+        """Get the shifts for ``shift_roi`` and ``stride``, reusing the shifts
+        of the previous call if those are the same (as in repeated requests
+        for the same ROIs)."""
+
+        key = (shift_roi.offset, shift_roi.shape, stride)
+
+        if self.shifts_cache is None or self.shifts_cache[0] != key:
+            self.shifts_cache = (key, self._enumerate_shifts(shift_roi, stride))
+        else:
+            logger.debug("reusing shifts of previous request")
+
+        return self.shifts_cache[1]
+
     def _enumerate_shifts(self, shift_roi, stride):
         """Produces a sequence of shift coordinates starting at the beginning
         of ``shift_roi``, progressing with ``stride``. The maximum shift
         coordinate in any dimension will be the last point inside the shift roi
-        in this dimension."""
+        in this dimension.
+
+        The shifts are returned as a read-only integer array of shape
+        ``(num_shifts, dims)``."""
 
         min_shift = shift_roi.offset
         max_shift = max(min_shift, Coordinate(m - 1 for m in shift_roi.end))
 
-        shift = np.array(min_shift)
-        shifts = []
+        logger.debug("enumerating possible shifts of %s in %s", stride, shift_roi)
 
-        dims = len(min_shift)
+        # all shifts along each axis, the last one snapped to the max shift
+        axes = [
+            np.concatenate([np.arange(mn, mx, st), [mx]])
+            for mn, mx, st in zip(min_shift, max_shift, stride)
+        ]
 
-        logger.debug("enumerating possible shifts of %s in %s", stride, shift_roi)
+        # all combinations of those, with the first dimension varying fastest
+        grid = np.meshgrid(*axes[::-1], indexing="ij")[::-1]
+        shifts = np.stack(grid, axis=-1).reshape(-1, len(axes))
 
-        while True:
-            logger.debug("adding %s", shift)
-            shifts.append(Coordinate(shift))
-
-            if (shift == max_shift).all():
-                break
-
-            # count up dimensions
-            for d in range(dims):
-                if shift[d] >= max_shift[d]:
-                    if d == dims - 1:
-                        break
-                    shift[d] = min_shift[d]
-                else:
-                    shift[d] += stride[d]
-                    # snap to last possible shift, don't overshoot
-                    if shift[d] > max_shift[d]:
-                        shift[d] = max_shift[d]
-                    break
+        # shifts are cached and shared between requests
+        shifts.setflags(write=False)
 
         return shifts
 
-    def _shift_request(self, request, shift):
-        shifted = request.copy()
-        for _, spec in shifted.items():
-            spec.roi = spec.roi.shift(shift)
+    def _shift_references(self, shifts):
+        """Lazily shift the reference request by each of ``shifts``. The new
+        ROI offsets are computed for up to 64 shifts at once.
+
+        The same copy of the reference is shifted in place and yielded for
+        each shift, so it is only valid until the next shift is requested.
+        This is safe for upstream requests, since ``request_batch`` passes
+        its own copy on to ``provide``."""
+
+        num_keys = len(self.reference)
+        shifted = None
+
+        for group in self._group_shifts(shifts, 64):
+            # offsets for each shift and each key in the reference
+            offsets = group[:, None, :] + self.reference_offsets[None]
+
+            for shift_offsets in offsets:
+                # request_batch removes placeholders from the request it was
+                # given, start over from the reference if that happened
+                if shifted is None or len(shifted) != num_keys:
+                    shifted = self.reference.copy()
+                for (_, spec), offset in zip(shifted.items(), shift_offsets):
+                    spec.roi = Roi(offset, spec.roi.shape)
+
+                yield shifted
+
+    def _get_group_size(self, num_chunks):
+        """Get the number of chunk requests to send to a worker at once. Small
+        enough to keep all workers busy (about four groups per worker) and to
+        hold at most ``cache_size`` batches with two groups per worker in
+        flight, but at most 64."""
+
+        return max(
+            1,
+            min(
+                64,
+                num_chunks // (4 * self.num_workers),
+                self.cache_size // (2 * self.num_workers),
+            ),
+        )
+
+    def _get_groups_per_worker(self, group_size):
+        """Get the number of groups to keep in flight per worker, two unless
+        that would hold more than ``cache_size`` batches, but at least one."""
+
+        return max(1, min(2, self.cache_size // (group_size * self.num_workers)))
+
+    def _group_shifts(self, shifts, group_size):
+        """Lazily split ``shifts`` into arrays of up to ``group_size``
+        shifts."""
+
+        for start in range(0, len(shifts), group_size):
+            yield shifts[start : start + group_size]
+
+    def _pin_worker(self, worker_index):
+        if not hasattr(os, "sched_setaffinity"):
+            logger.warning("can not pin workers to CPUs on this platform")
+            return
 
-        return shifted
+        cpus = sorted(os.sched_getaffinity(0))
+        cpu = cpus[worker_index % len(cpus)]
+
+        logger.debug("pinning worker %d to CPU %d", worker_index, cpu)
+        os.sched_setaffinity(0, {cpu})
+
+    def _wait_for_request(self, request_queue):
+        """Get the next group of shifts (and the batch target, if any) from
+        ``request_queue``. For small chunks, waking up a blocked worker takes
+        longer than processing them, therefore poll the queue for a bit before
+        blocking on it."""
+
+        for _ in range(100):
+            try:
+                return request_queue.get_nowait()
+            except queue.Empty:
+                time.sleep(0)
+
+        # back off exponentially, up to a few milliseconds
+        timeout = 0.0001
+        while timeout < 0.005:
+            try:
+                return request_queue.get(timeout=timeout)
+            except queue.Empty:
+                timeout *= 2
+
+        # nothing to do for a while (e.g., between requests), block
+        return request_queue.get()
+
+    def _worker_get_chunks(self, worker_index):
+        if self.pin_workers and not self.worker_pinned:
+            self._pin_worker(worker_index)
+            self.worker_pinned = True
+
+        # only the shifts are sent to the workers, they have their own copy
+        # of the reference request
+        shifts, target = self._wait_for_request(self.request_queues[worker_index])
+        chunks = [
+            self._get_chunk(shifted_reference)
+            for shifted_reference in self._shift_references(shifts)
+        ]
+
+        if target is not None:
+            self._fill_target(chunks, target)
+
+        if self.shared_memory:
+            for chunk in chunks:
+                for array in chunk.arrays.values():
+                    data = array.data
+                    if (
+                        data.nbytes >= SharedArrayData.min_bytes
+                        and not data.dtype.hasobject
+                    ):
+                        array.data = SharedArrayData(data)
+
+        return worker_index, chunks
+
+    def _fill_target(self, chunks, target):
+        """Fill the arrays of ``chunks`` directly into the batch arrays in
+        shared memory described by ``target``, and remove them from the
+        chunks."""
+
+        name, layout = target
+        shared_memory = multiprocessing.shared_memory.SharedMemory(name=name)
+
+        try:
+            for chunk in chunks:
+                for array_key, target_array in layout.items():
+                    if array_key not in chunk.arrays:
+                        continue
+                    offset, shape, dtype, roi, voxel_size = target_array
+                    array = chunk.arrays.pop(array_key)
+                    self._fill(
+                        np.ndarray(
+                            shape, dtype, buffer=shared_memory.buf, offset=offset
+                        ),
+                        array.data,
+                        roi,
+                        array.spec.roi,
+                        voxel_size,
+                    )
+        finally:
+            try:
+                shared_memory.close()
+            except BufferError:
+                # still referenced by the traceback of an exception, it will
+                # be unmapped once that is gone
+                pass
+
+    @contextlib.contextmanager
+    def _attach_shared_arrays(self, chunk):
+        """Temporarily replace the shared array data in ``chunk`` with numpy
+        arrays backed by the shared memory."""
+
+        shared = {}
+        for array_key, array in chunk.arrays.items():
+            if isinstance(array.data, SharedArrayData):
+                shared[array_key] = array.data
+                array.data = array.data.attach()
 
-    def _worker_get_chunk(self):
-        request = self.request_queue.get()
-        return self._get_chunk(request)
+        try:
+            yield
+        finally:
+            for array_key, data in shared.items():
+                chunk.arrays[array_key].data = data
+
+    def _release_shared_arrays(self, chunk):
+        for array in chunk.arrays.values():
+            if isinstance(array.data, SharedArrayData):
+                array.data.release()
 
     def _get_chunk(self, request):
         return self.get_upstream_provider().request_batch(request)
@@ -387,6 +715,7 @@ class Scan(BatchFilter):
 
         batch = Batch()
 
+        array_specs = {}
         for array_key, spec in batch_spec.array_specs.items():
             roi = spec.roi
             voxel_size = self.spec[array_key].voxel_size
@@ -399,9 +728,60 @@ class Scan(BatchFilter):
 
             spec = self.spec[array_key].copy()
             spec.roi = roi
+            array_specs[array_key] = (shape, spec)
+
+        # allocate (and zero) a single buffer for all arrays, each array is a
+        # view into it starting at a 64 byte boundary (except for arrays of
+        # objects, which can't be views into a buffer of bytes)
+        layout = {}
+        total_bytes = 0
+        for array_key, (shape, spec) in array_specs.items():
+            if np.dtype(spec.dtype).hasobject:
+                continue
+            nbytes = int(np.prod(shape)) * np.dtype(spec.dtype).itemsize
+            layout[array_key] = (total_bytes, nbytes)
+            total_bytes += -(-nbytes // 64) * 64
+
+        logger.debug("allocating %d bytes for %d arrays", total_bytes, len(layout))
+        if self.shared_memory and self.num_workers > 1:
+            # new shared memory is zeroed already
+            shared_memory = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=max(1, total_bytes)
+            )
+            buffer = np.ndarray((total_bytes,), np.uint8, buffer=shared_memory.buf)
+            # unmap the shared memory once all arrays using it are gone
+            weakref.finalize(buffer, shared_memory.close)
+        else:
+            shared_memory = None
+            buffer = np.zeros(total_bytes, dtype=np.uint8)
+
+        for array_key, (shape, spec) in array_specs.items():
+            dtype = np.dtype(spec.dtype)
+            if array_key in layout:
+                offset, nbytes = layout[array_key]
+                data = buffer[offset : offset + nbytes].view(dtype).reshape(shape)
+            else:
+                data = np.zeros(shape, dtype=dtype)
+
             logger.info("allocating array of shape %s for %s", shape, array_key)
-            batch.arrays[array_key] = Array(
-                data=np.zeros(shape, dtype=spec.dtype), spec=spec
+            batch.arrays[array_key] = Array(data=data, spec=spec)
+
+        if shared_memory is not None:
+            # tell workers where to put their chunks
+            self.batch_shared_memory = shared_memory
+            self.batch_target = (
+                shared_memory.name,
+                {
+                    array_key: (
+                        layout[array_key][0],
+                        shape,
+                        np.dtype(spec.dtype),
+                        spec.roi,
+                        spec.voxel_size,
+                    )
+                    for array_key, (shape, spec) in array_specs.items()
+                    if array_key in layout
+                },
             )
 
         for graph_key, spec in batch_spec.graph_specs.items():
@@ -415,26 +795,35 @@ class Scan(BatchFilter):
         return batch
 
     def _fill(self, a, b, roi_a, roi_b, voxel_size):
-        logger.debug("filling " + str(roi_b) + " into " + str(roi_a))
+        logger.debug("filling %s into %s", roi_b, roi_a)
 
         roi_a = roi_a // voxel_size
         roi_b = roi_b // voxel_size
 
-        common_roi = roi_a.intersect(roi_b)
-        if common_roi.empty:
-            return
+        # if the chunk matches the target exactly, copy all of it
+        if roi_a != roi_b:
+            common_roi = roi_a.intersect(roi_b)
+            if common_roi.empty:
+                return
 
-        common_in_a_roi = common_roi - roi_a.offset
-        common_in_b_roi = common_roi - roi_b.offset
+            common_in_a_roi = common_roi - roi_a.offset
+            common_in_b_roi = common_roi - roi_b.offset
 
-        slices_a = common_in_a_roi.get_bounding_box()
-        slices_b = common_in_b_roi.get_bounding_box()
+            slices_a = common_in_a_roi.get_bounding_box()
+            slices_b = common_in_b_roi.get_bounding_box()
 
-        if len(a.shape) > len(slices_a):
-            slices_a = (slice(None),) * (len(a.shape) - len(slices_a)) + slices_a
-            slices_b = (slice(None),) * (len(b.shape) - len(slices_b)) + slices_b
+            if len(a.shape) > len(slices_a):
+                slices_a = (slice(None),) * (len(a.shape) - len(slices_a)) + slices_a
+                slices_b = (slice(None),) * (len(b.shape) - len(slices_b)) + slices_b
 
-        a[slices_a] = b[slices_b]
+            a = a[slices_a]
+            b = b[slices_b]
+
+        if a.dtype == b.dtype and a.shape == b.shape:
+            # plain copy, no casting or broadcasting needed
+            np.copyto(a, b, casting="no")
+        else:
+            a[...] = b
 
     def _fill_points(self, a, b, roi_a, roi_b):
         """
@@ -452,16 +841,13 @@ class Scan(BatchFilter):
         if common_roi is None:
             return
 
+        # nodes of b contained in a, edges are only added between those
+        included_ids = set()
         for node in b.nodes:
             if not node.temporary and roi_a.contains(node.location):
                 a.add_node(node)
+                included_ids.add(node.id)
         for e in b.edges:
-            bu = b.node(e.u)
-            bv = b.node(e.v)
-            if (
-                not bu.temporary
-                and not bv.temporary
-                and a.contains(bu.id)
-                and a.contains(bv.id)
-            ):
+            # included nodes are never temporary
+            if e.u in included_ids and e.v in included_ids:
                 a.add_edge(e)
@@ -0,0 +1,117 @@
+import functools
+import os
+import time
+
+import numpy as np
+import pytest
+
+from gunpowder import (
+    Array,
+    ArrayKey,
+    ArraySpec,
+    Batch,
+    BatchProvider,
+    BatchRequest,
+    DaisyRequestBlocks,
+    Roi,
+    build,
+)
+from gunpowder.ext import NoSuchModule, daisy
+
+
+def read_pids(provided_file):
+    if not os.path.exists(provided_file):
+        return []
+    with open(provided_file) as f:
+        return f.read().split()
+
+
+def returned_twice(provided_file):
+    """Whether a daisy worker returned from two requests."""
+    pids = read_pids(provided_file)
+    return any(pids.count(pid) == 2 for pid in pids)
+
+
+class BlockCountingSource(BatchProvider):
+    def __init__(self, key, log_file, provided_file):
+        self.key = key
+        self.log_file = log_file
+        self.provided_file = provided_file
+
+    def setup(self):
+        self.provides(
+            self.key,
+            ArraySpec(roi=Roi((0, 0), (100, 100)), voxel_size=(1, 1), dtype=np.uint8),
+        )
+
+    def provide(self, request):
+        spec = self.spec[self.key].copy()
+        spec.roi = request[self.key].roi
+
+        # keep one block busy until the daisy worker that did not get it ran
+        # out of blocks and returned from both requests, daisy terminates all
+        # workers once the task is done
+        if spec.roi.offset == (0, 0):
+            timeout = time.time() + 60
+            while not returned_twice(self.provided_file):
+                assert time.time() < timeout, "second request did not return"
+                time.sleep(0.01)
+
+        # log each upstream request, workers might run in different processes
+        with open(self.log_file, "a") as f:
+            f.write("%d %d\n" % tuple(spec.roi.offset))
+
+        batch = Batch()
+        batch[self.key] = Array(np.zeros(spec.roi.shape, dtype=np.uint8), spec)
+        return batch
+
+
+def process_blocks(num_workers, log_file, provided_file):
+    raw_key = ArrayKey("RAW")
+
+    reference = BatchRequest()
+    reference.add(raw_key, (10, 10))
+
+    source = BlockCountingSource(raw_key, log_file, provided_file)
+    pipeline = source + DaisyRequestBlocks(
+        reference, {raw_key: "write_roi"}, num_workers=num_workers
+    )
+
+    with build(pipeline):
+        # the second request reuses the workers, and finds no blocks left
+        for _ in range(2):
+            pipeline.request_batch(BatchRequest())
+            with open(provided_file, "a") as f:
+                f.write("%d\n" % os.getpid())
+
+
+@pytest.mark.skipif(isinstance(daisy, NoSuchModule), reason="daisy is not installed")
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_request_blocks(num_workers, tmpdir, monkeypatch):
+    # daisy writes worker logs to the current directory
+    monkeypatch.chdir(tmpdir)
+
+    log_file = os.path.join(tmpdir, "requests.log")
+    provided_file = os.path.join(tmpdir, "provided.log")
+
+    task = daisy.Task(
+        "test_request_blocks_%d" % num_workers,
+        total_roi=daisy.Roi((0, 0), (100, 100)),
+        read_roi=daisy.Roi((0, 0), (10, 10)),
+        write_roi=daisy.Roi((0, 0), (10, 10)),
+        process_function=functools.partial(
+            process_blocks, num_workers, log_file, provided_file
+        ),
+        num_workers=2,
+    )
+
+    assert daisy.run_blockwise([task])
+
+    # exactly one upstream request per block
+    with open(log_file) as f:
+        offsets = sorted(tuple(int(x) for x in line.split()) for line in f)
+    assert offsets == [(i, j) for i in range(0, 100, 10) for j in range(0, 100, 10)]
+
+    # the daisy worker that finished first returned from both requests (the
+    # other one gets terminated once the task is done)
+    assert returned_twice(provided_file)
@@ -1,6 +1,10 @@
 import itertools
+import multiprocessing
+import os
+import time
 
 import numpy as np
+import pytest
 
 from gunpowder import (
     Array,
@@ -15,12 +19,18 @@ from gunpowder import (
     GraphKey,
     GraphKeys,
     GraphSpec,
+    MergeProvider,
     Node,
     Roi,
     Scan,
+    ScanCallback,
     build,
 )
 
+from gunpowder.nodes.scan import TqdmCallback
+
+from .helper_sources import ArraySource
+
 
 def coordinate_to_id(i, j, k):
     i, j, k = (i - 20000) // 100, (j - 2000) // 10, (k - 2000) // 10
@@ -158,3 +168,282 @@ def test_output():
     )
     with build(pipeline):
         batch = pipeline.request_batch(BatchRequest())
+
+
+def test_tqdm_callback(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    callback = TqdmCallback()
+    callback.start(10)
+
+    # updates within 0.1s of the last one are skipped
+    for num_processed in range(1, 5):
+        now[0] += 0.02
+        callback.update(num_processed)
+        assert callback.progress_bar.n == 0
+
+    # the accumulated count is passed on with the next update
+    now[0] += 0.05
+    callback.update(5)
+    assert callback.progress_bar.n == 5
+
+    # the last chunk is always shown
+    for num_processed in range(6, 11):
+        now[0] += 0.01
+        callback.update(num_processed)
+    assert callback.progress_bar.n == 10
+
+    callback.stop()
+
+
+@pytest.mark.parametrize(
+    "num_workers, shared_memory", [(1, False), (2, False), (2, True)]
+)
+def test_object_dtype(num_workers, shared_memory):
+    raw_key = ArrayKey("RAW")
+    objects_key = ArrayKey("OBJECTS")
+    raw_array = Array(
+        np.arange(40 * 40, dtype=np.float64).reshape(40, 40),
+        ArraySpec(roi=Roi((0, 0), (40, 40)), voxel_size=(1, 1)),
+    )
+    objects = np.empty((40, 40), dtype=object)
+    objects[:] = [[(i, j) for j in range(40)] for i in range(40)]
+    objects_array = Array(
+        objects,
+        ArraySpec(roi=Roi((0, 0), (40, 40)), voxel_size=(1, 1), dtype=object),
+    )
+
+    chunk_request = BatchRequest()
+    chunk_request.add(raw_key, (10, 10))
+    chunk_request.add(objects_key, (10, 10))
+
+    pipeline = (
+        (
+            ArraySource(raw_key, raw_array),
+            ArraySource(objects_key, objects_array),
+        )
+        + MergeProvider()
+        + Scan(chunk_request, num_workers=num_workers, shared_memory=shared_memory)
+    )
+
+    with build(pipeline):
+        roi = Roi((10, 0), (30, 20))
+        request = BatchRequest()
+        request[raw_key] = ArraySpec(roi=roi)
+        request[objects_key] = ArraySpec(roi=roi)
+
+        batch = pipeline.request_batch(request)
+
+        assert batch[objects_key].data.dtype == object
+        assert (batch[raw_key].data == raw_array.crop(roi, copy=False).data).all()
+        assert (
+            batch[objects_key].data == objects_array.crop(roi, copy=False).data
+        ).all()
+
+
+@pytest.mark.parametrize(
+    "num_workers, pin_workers", [(1, False), (2, False), (2, True)]
+)
+def test_repeated_requests(num_workers, pin_workers):
+    raw_key = ArrayKey("RAW")
+    raw_array = Array(
+        np.arange(40 * 40, dtype=np.uint16).reshape(40, 40),
+        ArraySpec(roi=Roi((0, 0), (40, 40)), voxel_size=(1, 1)),
+    )
+
+    chunk_request = BatchRequest()
+    chunk_request.add(raw_key, (10, 10))
+
+    pipeline = ArraySource(raw_key, raw_array) + Scan(
+        chunk_request, num_workers=num_workers, pin_workers=pin_workers
+    )
+
+    with build(pipeline):
+        for roi in [
+            Roi((0, 0), (20, 30)),
+            Roi((0, 0), (20, 30)),
+            Roi((10, 10), (30, 30)),
+            Roi((20, 0), (10, 10)),
+        ]:
+            request = BatchRequest()
+            request[raw_key] = ArraySpec(roi=roi)
+
+            batch = pipeline.request_batch(request)
+
+            assert batch[raw_key].spec.roi == roi
+            assert (batch[raw_key].data == raw_array.crop(roi, copy=False).data).all()
+
+
+class AffinityRecordingSource(ArraySource):
+    def __init__(self, key, array, log_file):
+        super().__init__(key, array)
+        self.log_file = log_file
+
+    def provide(self, request):
+        cpus = ",".join(str(cpu) for cpu in sorted(os.sched_getaffinity(0)))
+        with open(self.log_file, "a") as f:
+            f.write("%d %s\n" % (os.getpid(), cpus))
+        return super().provide(request)
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "sched_setaffinity"), reason="CPU affinity not supported"
+)
+def test_pin_workers(tmpdir):
+    raw_key = ArrayKey("RAW")
+    raw_array = Array(
+        np.zeros((40, 40), dtype=np.uint8),
+        ArraySpec(roi=Roi((0, 0), (40, 40)), voxel_size=(1, 1)),
+    )
+
+    chunk_request = BatchRequest()
+    chunk_request.add(raw_key, (10, 10))
+
+    log_file = os.path.join(tmpdir, "affinity.log")
+    cpus = os.sched_getaffinity(0)
+
+    pipeline = AffinityRecordingSource(raw_key, raw_array, log_file) + Scan(
+        chunk_request, num_workers=2, pin_workers=True
+    )
+
+    with build(pipeline):
+        request = BatchRequest()
+        request[raw_key] = ArraySpec(roi=Roi((0, 0), (40, 40)))
+        pipeline.request_batch(request)
+
+    with open(log_file) as f:
+        worker_cpus = dict(line.split() for line in f)
+
+    # each worker ran on a single CPU, different ones if possible
+    assert len(worker_cpus) == 2
+    assert str(os.getpid()) not in worker_cpus
+    assert all("," not in cpu for cpu in worker_cpus.values())
+    if len(cpus) > 1:
+        assert len(set(worker_cpus.values())) == len(worker_cpus)
+
+    # this process is not pinned
+    assert os.sched_getaffinity(0) == cpus
+
+
+class CountingArraySource(ArraySource):
+    def __init__(self, key, array, num_provided):
+        super().__init__(key, array)
+        self.num_provided = num_provided
+
+    def provide(self, request):
+        with self.num_provided.get_lock():
+            self.num_provided.value += 1
+        return super().provide(request)
+
+
+class FirstUpdateCallback(ScanCallback):
+    def __init__(self, num_provided):
+        self.num_provided = num_provided
+        self.num_provided_at_first_update = None
+
+    def update(self, num_processed):
+        if self.num_provided_at_first_update is None:
+            self.num_provided_at_first_update = self.num_provided.value
+
+
+def test_cache_size():
+    raw_key = ArrayKey("RAW")
+    raw_array = Array(
+        np.zeros((400, 400), dtype=np.uint8),
+        ArraySpec(roi=Roi((0, 0), (400, 400)), voxel_size=(1, 1)),
+    )
+
+    chunk_request = BatchRequest()
+    chunk_request.add(raw_key, (10, 10))
+
+    num_provided = multiprocessing.Value("i", 0)
+    callback = FirstUpdateCallback(num_provided)
+
+    pipeline = CountingArraySource(raw_key, raw_array, num_provided) + Scan(
+        chunk_request, num_workers=2, cache_size=1, progress_callback=callback
+    )
+
+    with build(pipeline):
+        request = BatchRequest()
+        request[raw_key] = ArraySpec(roi=Roi((0, 0), (400, 400)))
+        pipeline.request_batch(request)
+
+    # workers don't produce more than cache_size batches (plus the ones
+    # they are holding on to) ahead of this process
+    assert num_provided.value == 1600
+    assert callback.num_provided_at_first_update <= 4
+
+
+def test_shared_memory():
+    raw_key = ArrayKey("RAW")
+    raw_array = Array(
+        np.random.rand(400, 300),
+        ArraySpec(roi=Roi((0, 0), (400, 300)), voxel_size=(1, 1)),
+    )
+
+    # chunks of 100x100 float64 are sent via shared memory
+    chunk_request = BatchRequest()
+    chunk_request.add(raw_key, (100, 100))
+
+    pipeline = ArraySource(raw_key, raw_array) + Scan(
+        chunk_request, num_workers=2, shared_memory=True
+    )
+
+    with build(pipeline):
+        for roi in [Roi((0, 0), (400, 300)), Roi((50, 100), (200, 200))]:
+            request = BatchRequest()
+            request[raw_key] = ArraySpec(roi=roi)
+
+            batch = pipeline.request_batch(request)
+
+            assert (batch[raw_key].data == raw_array.crop(roi, copy=False).data).all()
+
+        # scanning without returning anything
+        pipeline.request_batch(BatchRequest())
+
+
+class PlaceholderTestSource(BatchProvider):
+    def __init__(self, raw_key, placeholder_key):
+        self.raw_key = raw_key
+        self.placeholder_key = placeholder_key
+        self.num_placeholders = 0
+
+    def setup(self):
+        self.enable_placeholders()
+        spec = ArraySpec(roi=Roi((0, 0), (40, 40)), voxel_size=(1, 1), dtype=np.uint8)
+        self.provides(self.raw_key, spec)
+        self.provides(self.placeholder_key, spec.copy())
+
+    def provide(self, request):
+        if request[self.placeholder_key].placeholder:
+            self.num_placeholders += 1
+
+        batch = Batch()
+        spec = self.spec[self.raw_key].copy()
+        spec.roi = request[self.raw_key].roi
+        batch[self.raw_key] = Array(np.ones(spec.roi.shape, dtype=np.uint8), spec)
+        return batch
+
+
+def test_placeholder_reference():
+    raw_key = ArrayKey("RAW")
+    placeholder_key = ArrayKey("PLACEHOLDER")
+
+    # placeholders are removed from a request once it was passed upstream,
+    # they should still be part of every chunk request
+    chunk_request = BatchRequest()
+    chunk_request.add(raw_key, (10, 10))
+    chunk_request.add(placeholder_key, (10, 10), placeholder=True)
+
+    source = PlaceholderTestSource(raw_key, placeholder_key)
+    pipeline = source + Scan(chunk_request)
+
+    with build(pipeline):
+        request = BatchRequest()
+        request[raw_key] = ArraySpec(roi=Roi((0, 0), (40, 40)))
+
+        batch = pipeline.request_batch(request)
+
+        assert (batch[raw_key].data == 1).all()
+        assert source.num_placeholders == 16